@@ -0,0 +1,387 @@
+from collections import namedtuple
+
+import numpy as np
+from numba import njit, prange
+
+# Every per-frame kernel is compiled with the same options: rows are spread
+# across cores with prange, and the GIL is released so frame processing can
+# run on a worker thread alongside encoding. The module-level kernels are
+# cached next to this file, so they only compile on the very first run; the
+# per-clip frame kernel from build_frame_kernel can't be cached and is
+# compiled again on every run (a few seconds).
+JIT_OPTIONS = dict(parallel=True, fastmath=True, boundscheck=False, nogil=True, cache=True)
+
+# --- SCALAR HELPERS ---
+
+@njit(inline='always')
+def _clip(v):
+    return min(max(v, 0.0), 255.0)
+
+@njit(inline='always')
+def _clip_int(v):
+    return min(max(v, 0), 255)
+
+@njit(inline='always')
+def _luma_int(r, g, b):
+    # Fixed-point Rec.601 luma: 0.299, 0.587, 0.114 in 1/256ths
+    return (77 * r + 150 * g + 29 * b) >> 8
+
+# --- CLARITY SOFTENING (RECURSIVE GAUSSIAN) ---
+# Young / van Vliet recursive Gaussian: a forward and a backward 3-tap IIR
+# sweep per axis, so the cost per pixel does not depend on sigma.
+# Borders are replicated: the forward sweep starts from the edge pixel's
+# steady state, and the backward sweep starts from the Triggs–Sdika state,
+# i.e. what it would be after running in from an infinite replicated border.
+
+def vyv_coefficients(sigma):
+    """
+    Returns the normalized (B, b1, b2, b3) feedback coefficients for sigma,
+    followed by the 3x3 Triggs–Sdika boundary matrix M (row-major).
+    Computed once per clip; the approximation is only valid for sigma >= 0.5.
+    """
+    sigma = max(sigma, 0.5)
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * np.sqrt(1.0 - 0.26891 * sigma)
+
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = (2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3) / b0
+    b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3) / b0
+    b3 = (0.422205 * q ** 3) / b0
+    B = 1.0 - (b1 + b2 + b3)
+
+    # M maps the forward sweep's last three outputs (minus the edge value) to
+    # the backward sweep's starting state. Both sweeps share the companion
+    # matrix A, and M is the fixed point of M = A M A + B e1 A[0], solved
+    # exactly here rather than with Triggs and Sdika's expanded closed form.
+    A = np.array([[b1, b2, b3], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    rhs = B * np.outer([1.0, 0.0, 0.0], A[0])
+    M = np.linalg.solve(np.eye(9) - np.kron(A, A.T), rhs.ravel())
+    return np.concatenate(([B, b1, b2, b3], M)).astype(np.float32)
+
+@njit(inline='always')
+def _backward_state(coeffs, u, e1, e2, e3):
+    # Triggs–Sdika start state for the backward sweep, from the forward
+    # sweep's last three outputs e1..e3 (e1 at the edge) and edge value u.
+    e1, e2, e3 = e1 - u, e2 - u, e3 - u
+    w1 = u + coeffs[4] * e1 + coeffs[5] * e2 + coeffs[6] * e3
+    w2 = u + coeffs[7] * e1 + coeffs[8] * e2 + coeffs[9] * e3
+    w3 = u + coeffs[10] * e1 + coeffs[11] * e2 + coeffs[12] * e3
+    return w1, w2, w3
+
+@njit(**JIT_OPTIONS)
+def _gblur_rows(src, scratch, coeffs):
+    B, b1, b2, b3 = coeffs[0], coeffs[1], coeffs[2], coeffs[3]
+    h, w = src.shape[0], src.shape[1]
+    for y in prange(h):
+        for c in range(3):
+            # Forward sweep, primed with the edge pixel's steady state
+            w1 = w2 = w3 = np.float32(src[y, 0, c])
+            for x in range(w):
+                v = B * src[y, x, c] + b1 * w1 + b2 * w2 + b3 * w3
+                scratch[y, x, c] = v
+                w3, w2, w1 = w2, w1, v
+            # Backward sweep, in place
+            w1, w2, w3 = _backward_state(
+                coeffs, np.float32(src[y, w - 1, c]),
+                scratch[y, w - 1, c], scratch[y, w - 2, c], scratch[y, w - 3, c]
+            )
+            for x in range(w - 1, -1, -1):
+                v = B * scratch[y, x, c] + b1 * w1 + b2 * w2 + b3 * w3
+                scratch[y, x, c] = v
+                w3, w2, w1 = w2, w1, v
+
+@njit(**JIT_OPTIONS)
+def _gblur_cols(scratch, dst, coeffs):
+    B, b1, b2, b3 = coeffs[0], coeffs[1], coeffs[2], coeffs[3]
+    h = scratch.shape[0]
+    # View the frame as (H, W*3) and give each thread a strip of columns, so
+    # every row step touches a contiguous run of memory.
+    n = scratch.shape[1] * 3
+    s = scratch.reshape((h, n))
+    d = dst.reshape((h, n))
+    chunk = 64
+    for j in prange((n + chunk - 1) // chunk):
+        c0 = j * chunk
+        c1 = min(c0 + chunk, n)
+        # The forward sweep overwrites the bottom row's input, so keep it
+        edge = s[h - 1, c0:c1].copy()
+        w1 = s[0, c0:c1].copy()
+        w2 = w1.copy()
+        w3 = w1.copy()
+        for y in range(h):
+            for i in range(c1 - c0):
+                v = B * s[y, c0 + i] + b1 * w1[i] + b2 * w2[i] + b3 * w3[i]
+                s[y, c0 + i] = v
+                w3[i] = w2[i]
+                w2[i] = w1[i]
+                w1[i] = v
+        for i in range(c1 - c0):
+            w1[i], w2[i], w3[i] = _backward_state(
+                coeffs, edge[i], s[h - 1, c0 + i], s[h - 2, c0 + i], s[h - 3, c0 + i]
+            )
+        for y in range(h - 1, -1, -1):
+            for i in range(c1 - c0):
+                v = B * s[y, c0 + i] + b1 * w1[i] + b2 * w2[i] + b3 * w3[i]
+                d[y, c0 + i] = np.uint8(_clip(v + 0.5))
+                w3[i] = w2[i]
+                w2[i] = w1[i]
+                w1[i] = v
+
+def gblur_vyv(src, dst, coeffs, scratch):
+    """
+    Gaussian blur of a uint8 (H, W, 3) frame into dst.
+    scratch is a float32 buffer of the same shape, reused across frames.
+    """
+    _gblur_rows(src, scratch, coeffs)
+    _gblur_cols(scratch, dst, coeffs)
+    return dst
+
+# --- FILM SIMULATIONS ---
+# Per-pixel grade functions, inlined into the frame kernel.
+# Each takes one source pixel plus its grain sample and returns the graded
+# (r, g, b), already clipped to [0, 255].
+#
+# Each filter's ImageEnhance chain is folded into ONE affine op per channel:
+#   out = k_px * px + k_luma * luma + bias
+# Brightness(a) is px * a and Contrast(c) is (px - 128) * c + 128, so any
+# chain of them is px * k + m with the same k, m on every channel. Luma is
+# linear, so a following Color(s) (luma + (px - luma) * s) gives
+#   k_px = s * k,  k_luma = (1 - s) * k,  bias = m
+# with luma taken straight from the source pixel. Kept in 8-bit fixed point.
+
+def _affine_q8(k, m, s):
+    return (round(s * k * 256), round((1 - s) * k * 256), round(m * 256))
+
+# Contrast 0.95, Brightness 1.05
+FUJI_AFFINE = _affine_q8(0.95 * 1.05, 128 * 0.05 * 1.05, 1.0)
+# Contrast 0.85, Color 1.35
+TERRACOTTA_AFFINE = _affine_q8(0.85, 128 * 0.15, 1.35)
+# Brightness 1.08, Contrast 0.85, Color 1.3
+PORTRA_AFFINE = _affine_q8(1.08 * 0.85, 128 * 0.15, 1.3)
+# Contrast 0.8, Color 1.2 (Brightness 1.0 is a no-op)
+REALA_AFFINE = _affine_q8(0.8, 128 * 0.2, 1.2)
+# Contrast 0.90, Color 1.50
+DREAMY_AFFINE = _affine_q8(0.9, 128 * 0.1, 1.5)
+
+# Purely per-channel, monotonic tone steps are baked into 256-entry uint8
+# tables (768 B per filter, always in L1): one load replaces the
+# multiply/add/clip. Numba freezes these global arrays into the kernel.
+_LEVELS = np.arange(256, dtype=np.int64)
+
+def _shift_lut(shifts):
+    # (3, 256): clip(v + shift) for each channel
+    return np.clip(_LEVELS[None, :] + np.array(shifts)[:, None], 0, 255).astype(np.uint8)
+
+# Fuji has no Color step (k_luma = 0), so its whole enhance is one table
+FUJI_LUT = np.clip((FUJI_AFFINE[0] * _LEVELS + FUJI_AFFINE[2]) >> 8, 0, 255).astype(np.uint8)
+# R + 19, G + 10, B - 33
+PORTRA_SHIFT_LUT = _shift_lut((19, 10, -33))
+# R - 11, G + 10, B + 11
+REALA_SHIFT_LUT = _shift_lut((-11, 10, 11))
+
+@njit(inline='always')
+def _enhance(r, g, b, affine):
+    k_px, k_luma, bias = affine
+    luma = k_luma * _luma_int(r, g, b) + bias
+    return (_clip_int((k_px * r + luma) >> 8),
+            _clip_int((k_px * g + luma) >> 8),
+            _clip_int((k_px * b + luma) >> 8))
+
+@njit(inline='always')
+def fuji_grade(r, g, b, nr, ng, nb):
+    r = np.int32(FUJI_LUT[r])
+    g = np.int32(FUJI_LUT[g])
+    b = np.int32(FUJI_LUT[b])
+
+    # Blend 5% Luma (Saturation reduction/Bleach bypass effect): 243/256, 13/256
+    luma = _luma_int(r, g, b) * 13
+    # R + 15, G + 5, B - 10
+    return (_clip_int(((r + 15) * 243 + luma) >> 8),
+            _clip_int(((g + 5) * 243 + luma) >> 8),
+            _clip_int(((b - 10) * 243 + luma) >> 8))
+
+@njit(inline='always')
+def terracotta_grade(r, g, b, nr, ng, nb):
+    r, g, b = _enhance(r, g, b, TERRACOTTA_AFFINE)
+
+    # Blue areas get a cooler shift than the rest.
+    # Written as selects rather than an if/else block so LLVM can if-convert
+    # the row loop and vectorize it.
+    is_blue = b > ((r + g) >> 1) + 30
+    r += 15 if is_blue else 40
+    g -= 10 if is_blue else 5
+    b -= 70 if is_blue else 35
+
+    # Grain
+    return (_clip_int(_clip_int(r) + nr),
+            _clip_int(_clip_int(g) + ng),
+            _clip_int(_clip_int(b) + nb))
+
+@njit(inline='always')
+def portra_grade(r, g, b, nr, ng, nb):
+    r, g, b = _enhance(r, g, b, PORTRA_AFFINE)
+
+    # Color shift, then Grain
+    return (_clip_int(PORTRA_SHIFT_LUT[0, r] + nr),
+            _clip_int(PORTRA_SHIFT_LUT[1, g] + ng),
+            _clip_int(PORTRA_SHIFT_LUT[2, b] + nb))
+
+@njit(inline='always')
+def reala_grade(r, g, b, nr, ng, nb):
+    r, g, b = _enhance(r, g, b, REALA_AFFINE)
+
+    # Color shift, then Grain
+    return (_clip_int(REALA_SHIFT_LUT[0, r] + nr),
+            _clip_int(REALA_SHIFT_LUT[1, g] + ng),
+            _clip_int(REALA_SHIFT_LUT[2, b] + nb))
+
+@njit(inline='always')
+def dreamy_grade(r, g, b, nr, ng, nb):
+    r, g, b = _enhance(r, g, b, DREAMY_AFFINE)
+
+    # WB Shift: R+20, B-20
+    r += 20
+    b -= 20
+
+    # Lift Shadows (luma < 60) by 0.2, Darken Highlights (luma > 200) by 0.15.
+    # At most one of the two terms is non-zero, so no branch is needed.
+    luma = _luma_int(r, g, b)
+    tone = ((max(60 - luma, 0) * 51) >> 8) - ((max(luma - 200, 0) * 38) >> 8)
+    r += tone
+    g += tone
+    b += tone
+
+    # Grain
+    return (_clip_int(_clip_int(r) + nr),
+            _clip_int(_clip_int(g) + ng),
+            _clip_int(_clip_int(b) + nb))
+
+# --- ROW PASSES ---
+# Each pass works on single (W, 3) rows, so the frame kernel can chain them
+# on a strip of rows while it is still in cache.
+
+@njit(inline='always')
+def _composite_row(row, ovl_rgb_row, ovl_a_row, x0, x1):
+    # Alpha "over" of the static overlay, only on the visible [x0, x1) span
+    for x in range(x0, x1):
+        a = np.int32(ovl_a_row[x])
+        if a == 0:
+            continue
+        for c in range(3):
+            v = np.int32(ovl_rgb_row[x, c]) * a + np.int32(row[x, c]) * (255 - a)
+            row[x, c] = np.uint8((v + 127) // 255)
+
+@njit(inline='always')
+def _shift_row(src_row, dst_row, ca_shift, dx):
+    # Red is pulled from ca_shift pixels to the right, blue from ca_shift
+    # pixels to the left, and the row is offset by dx. Indices are clamped,
+    # so the edges replicate instead of wrapping around.
+    w = src_row.shape[0]
+    for x in range(w):
+        sx = x - dx
+        dst_row[x, 0] = src_row[min(max(sx + ca_shift, 0), w - 1), 0]
+        dst_row[x, 1] = src_row[min(max(sx, 0), w - 1), 1]
+        dst_row[x, 2] = src_row[min(max(sx - ca_shift, 0), w - 1), 2]
+
+@njit(inline='always')
+def _leak_row(row, leak_row, opacity_q8):
+    # Additive blend, in place: row + leak * opacity, with opacity in 8-bit
+    # fixed point (<= 256, so leak * opacity fits in 16 bits). One flat,
+    # unsigned loop over the contiguous row bytes vectorizes cleanly to
+    # packed multiply / shift / min.
+    flat = row.reshape(-1)
+    flat_leak = leak_row.reshape(-1)
+    op = np.uint32(opacity_q8)
+    for i in range(flat.shape[0]):
+        v = np.uint32(flat[i]) + ((np.uint32(flat_leak[i]) * op) >> 8)
+        flat[i] = np.uint8(min(v, 255))
+
+# --- SPECIALIZED FRAME KERNEL ---
+
+# The frame is processed in strips of this many rows: every pass runs on a
+# strip before moving on, so the strip is read from DRAM once and stays in
+# L2 (64 rows of 4K RGB is ~740 KB, of 1080p ~370 KB).
+STRIP_ROWS = 64
+
+# Static overlay, pre-split once per clip: RGB colors, alpha, and the
+# [x0, x1) span of non-zero alpha on each row
+OverlayPlanes = namedtuple('OverlayPlanes', ['rgb', 'alpha', 'x0', 'x1'])
+
+# Stand-in leak for frames (or clips) without one
+NO_LEAK = np.zeros((1, 1, 3), dtype=np.uint8)
+
+# Stand-in grain for clips without any (never read: grain is compiled out)
+NO_GRAIN = np.zeros((1, 1, 3), dtype=np.int8)
+
+def strip_stage(frame_shape, max_jitter):
+    """
+    Scratch space for build_frame_kernel: one staging strip per thread-strip,
+    with max_jitter halo rows above and below for the vertical shift.
+    """
+    height, width = frame_shape[0], frame_shape[1]
+    n_strips = (height + STRIP_ROWS - 1) // STRIP_ROWS
+    return np.empty((n_strips, STRIP_ROWS + 2 * max_jitter, width, 3), dtype=np.uint8)
+
+def build_frame_kernel(grade, grain, ca_shift, max_jitter, leaks):
+    """
+    Compiles the whole per-frame pipeline (grade + grain, overlay, chromatic
+    aberration / jitter, light leak) into one kernel for this clip's settings.
+    The settings are closure constants, so Numba folds them in and the
+    branches for disabled effects are compiled out entirely.
+
+    The returned kernel is called as
+        kernel(src, dst, stage, noise, overlay, dx, dy, leak, opacity_q8)
+    where overlay is an OverlayPlanes, stage comes from strip_stage() and
+    |dx|, |dy| <= max_jitter.
+    """
+    shift = ca_shift != 0 or max_jitter != 0
+    halo = max_jitter
+    options = dict(JIT_OPTIONS, cache=False)  # closures can't share a cache entry
+
+    @njit(inline='always')
+    def graded_row(src_row, noise, out_row, overlay, y):
+        for x in range(src_row.shape[0]):
+            if grain:
+                nr = np.int32(noise[y, x, 0])
+                ng = np.int32(noise[y, x, 1])
+                nb = np.int32(noise[y, x, 2])
+            else:
+                nr = ng = nb = np.int32(0)
+            r, g, b = grade(src_row[x, 0], src_row[x, 1], src_row[x, 2], nr, ng, nb)
+            out_row[x, 0] = np.uint8(r)
+            out_row[x, 1] = np.uint8(g)
+            out_row[x, 2] = np.uint8(b)
+        _composite_row(out_row, overlay.rgb[y], overlay.alpha[y], overlay.x0[y], overlay.x1[y])
+
+    @njit(**options)
+    def frame_kernel(src, dst, stage, noise, overlay, dx, dy, leak, opacity_q8):
+        h = src.shape[0]
+        blend_leak = leaks and opacity_q8 > 0
+
+        for s in prange((h + STRIP_ROWS - 1) // STRIP_ROWS):
+            y0 = s * STRIP_ROWS
+            y1 = min(y0 + STRIP_ROWS, h)
+
+            if shift:
+                # Grade the strip plus its halo rows into this strip's stage,
+                # then gather the shifted pixels out of it
+                r0 = max(y0 - halo, 0)
+                r1 = min(y1 + halo, h)
+                buf = stage[s]
+                for y in range(r0, r1):
+                    graded_row(src[y], noise, buf[y - r0], overlay, y)
+                for y in range(y0, y1):
+                    sy = min(max(y - dy, 0), h - 1)
+                    _shift_row(buf[sy - r0], dst[y], ca_shift, dx)
+                    if blend_leak:
+                        _leak_row(dst[y], leak[y], opacity_q8)
+            else:
+                for y in range(y0, y1):
+                    graded_row(src[y], noise, dst[y], overlay, y)
+                    if blend_leak:
+                        _leak_row(dst[y], leak[y], opacity_q8)
+        return dst
+
+    return frame_kernel
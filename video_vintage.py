@@ -1,12 +1,29 @@
 from moviepy import VideoFileClip
+from moviepy.config import FFMPEG_BINARY
 import numpy as np
-from PIL import Image, ImageEnhance, ImageDraw, ImageFilter, ImageFont
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
 import os
 import random
 from datetime import datetime
 import sys
 import logging
 import glob
+import subprocess
+import tempfile
+import itertools
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import cv2  # Optional: SIMD Gaussian blur for the timestamp glow
+except ImportError:
+    cv2 = None
+
+from filters_numba import (
+    fuji_grade, terracotta_grade, portra_grade, reala_grade, dreamy_grade,
+    gblur_vyv, vyv_coefficients, build_frame_kernel, strip_stage, OverlayPlanes, NO_LEAK, NO_GRAIN,
+)
 
 # --- LOGGING SETUP ---
 logging.basicConfig(
@@ -20,14 +37,68 @@ logger = logging.getLogger(__name__)
 
 # --- HELPER FUNCTIONS ---
 
-def apply_clarity_softening(img, strength):
+class FrameWorkspace:
+    """
+    Every per-frame buffer, allocated ONCE per clip and reused for all frames.
+    """
+    def __init__(self, video_size, max_jitter, softening):
+        width, height = video_size
+        frame_shape = (height, width, 3)
+        # Two output frames, alternated, so the pipeline can fill one while
+        # the encoder is still reading the other
+        self._outputs = itertools.cycle([np.empty(frame_shape, dtype=np.uint8) for _ in range(2)])
+        self.stage = strip_stage(frame_shape, max_jitter)
+        # Blur scratch only exists when the film simulation softens
+        self.blur_scratch = np.empty(frame_shape, dtype=np.float32) if softening else None
+        self.softened = np.empty(frame_shape, dtype=np.uint8) if softening else None
+
+    def next_output(self):
+        return next(self._outputs)
+
+class ClaritySoftener:
     """
     Applies a subtle Gaussian blur to simulate lens softening or halation.
+    Coefficients are set up once per clip; buffers come from the FrameWorkspace.
     """
-    if strength > 0:
-        radius = strength / 2.5 
-        img = img.filter(ImageFilter.GaussianBlur(radius))
-    return img
+    def __init__(self, strength, workspace):
+        self.coeffs = vyv_coefficients(strength / 2.5)
+        self.workspace = workspace
+
+    def apply(self, frame_arr):
+        ws = self.workspace
+        return gblur_vyv(frame_arr, ws.softened, self.coeffs, ws.blur_scratch)
+
+def _blur_rgba(img, sigma):
+    """
+    Gaussian blur of an RGBA image, using OpenCV's SIMD kernels when available.
+    """
+    if cv2 is None:
+        return img.filter(ImageFilter.GaussianBlur(sigma))
+    arr = np.array(img)
+    cv2.GaussianBlur(arr, (0, 0), sigmaX=sigma, dst=arr)
+    return Image.fromarray(arr, 'RGBA')
+
+@functools.lru_cache(maxsize=16)
+def _load_font(size):
+    """Loads the timestamp font once per size (FreeType loading is slow)."""
+    try:
+        # Try Bold variant first for better legibility
+        return ImageFont.truetype("Arial Bold.ttf", size)
+    except IOError:
+        try:
+            return ImageFont.truetype("arial.ttf", size)
+        except IOError:
+            # Fallback to default, trying to approximate size
+            try:
+                 return ImageFont.load_default(size=size)
+            except TypeError:
+                 # Older PIL versions don't support size in load_default
+                 return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=64)
+def _text_bbox(text, size):
+    """Bounding box of text drawn at (0, 0) in the timestamp font."""
+    return _load_font(size).getbbox(text)
 
 def create_timestamp_overlay(video_size, timestamp_text, message_text=""):
     """
@@ -43,27 +114,13 @@ def create_timestamp_overlay(video_size, timestamp_text, message_text=""):
     HALO_COLOR = (255, 120, 0, 180) # Increased alpha from 120 for stronger contrast
     
     font_size = int(height * FONT_SIZE_MULTIPLIER) 
-    try:
-        # Try Bold variant first for better legibility
-        font = ImageFont.truetype("Arial Bold.ttf", font_size)
-    except IOError:
-        try:
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except IOError:
-            # Fallback to default, trying to approximate size
-            try:
-                 font = ImageFont.load_default(size=font_size)
-            except TypeError:
-                 # Older PIL versions don't support size in load_default
-                 font = ImageFont.load_default()
+    font = _load_font(font_size)
     
     padding_x = int(width * 0.03)
     padding_y = int(height * 0.03)
     
-    draw = ImageDraw.Draw(overlay)
-    
     # --- Date Position ---
-    bbox_date = draw.textbbox((0, 0), timestamp_text, font=font)
+    bbox_date = _text_bbox(timestamp_text, font_size)
     date_text_height = bbox_date[3] - bbox_date[1]
     date_pos = (padding_x, height - date_text_height - padding_y)
     
@@ -72,25 +129,34 @@ def create_timestamp_overlay(video_size, timestamp_text, message_text=""):
     # --- Message Position ---
     clean_message = message_text.strip()
     if clean_message:
-        bbox_msg = draw.textbbox((0, 0), clean_message, font=font)
+        bbox_msg = _text_bbox(clean_message, font_size)
         msg_width = bbox_msg[2] - bbox_msg[0]
         msg_pos = (width - padding_x - msg_width, padding_y)
         texts_to_draw.append((clean_message, msg_pos, font))
 
     # --- GLOW LAYER ---
-    # We draw the glow on a separate layer to blur it, then composite
-    glow_layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    glow_draw = ImageDraw.Draw(glow_layer)
+    # The glow is drawn on a small patch around each text, blurred there,
+    # and composited back, rather than blurring a full-frame layer.
+    GLOW_PADDING = 8
 
     for text, (x, y), f in texts_to_draw:
+        left, top, right, bottom = _text_bbox(text, font_size)
+        left = max(x + left - GLOW_PADDING, 0)
+        top = max(y + top - GLOW_PADDING, 0)
+        right = x + right + GLOW_PADDING
+        bottom = y + bottom + GLOW_PADDING
+
+        patch = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+        patch_draw = ImageDraw.Draw(patch)
+        px, py = x - left, y - top
         for i in range(3, 0, -1):
-            glow_draw.text((x+i, y+i), text, fill=HALO_COLOR, font=f)
-            glow_draw.text((x-i, y-i), text, fill=HALO_COLOR, font=f)
-            glow_draw.text((x, y+i), text, fill=HALO_COLOR, font=f)
-            glow_draw.text((x, y-i), text, fill=HALO_COLOR, font=f)
-    
-    glow_layer = glow_layer.filter(ImageFilter.GaussianBlur(1.5))
-    overlay = Image.alpha_composite(overlay, glow_layer)
+            patch_draw.text((px+i, py+i), text, fill=HALO_COLOR, font=f)
+            patch_draw.text((px-i, py-i), text, fill=HALO_COLOR, font=f)
+            patch_draw.text((px, py+i), text, fill=HALO_COLOR, font=f)
+            patch_draw.text((px, py-i), text, fill=HALO_COLOR, font=f)
+        
+        patch = _blur_rgba(patch, 1.5)
+        overlay.alpha_composite(patch, dest=(left, top))
     
     # --- CORE TEXT ---
     draw_final = ImageDraw.Draw(overlay)
@@ -99,56 +165,47 @@ def create_timestamp_overlay(video_size, timestamp_text, message_text=""):
         
     return overlay
 
-def add_noise_vectorized(arr, amount):
-    """Adds random noise to a numpy array efficiently."""
-    if amount <= 0:
-        return arr
-    
-    # Generate random noise in the range [-amount, amount]
-    noise = np.random.randint(-amount, amount + 1, arr.shape, dtype=np.int16)
-    
-    # Add noise and clip
-    arr = arr.astype(np.int16) + noise
-    return np.clip(arr, 0, 255).astype(np.uint8)
-
-def apply_chromatic_aberration(arr, shift_amount=2):
+def split_overlay(overlay_img):
     """
-    Simulates chromatic aberration by shifting Red and Blue channels.
+    Splits the RGBA overlay into the OverlayPlanes the frame kernel needs.
     """
-    if shift_amount == 0:
-        return arr
-        
-    # Shift Red channel left
-    arr[..., 0] = np.roll(arr[..., 0], -shift_amount, axis=1)
-    # Shift Blue channel right
-    arr[..., 2] = np.roll(arr[..., 2], shift_amount, axis=1)
-    
-    return arr
+    ovl_rgb = np.ascontiguousarray(np.asarray(overlay_img.convert('RGB')))
+    ovl_a = np.ascontiguousarray(np.asarray(overlay_img.getchannel('A')))
 
-def apply_jitter(arr, max_shift=2):
+    visible = ovl_a > 0
+    has_any = visible.any(axis=1)
+    row_x0 = np.where(has_any, visible.argmax(axis=1), 0).astype(np.int64)
+    row_x1 = np.where(has_any, visible.shape[1] - visible[:, ::-1].argmax(axis=1), 0).astype(np.int64)
+    return OverlayPlanes(ovl_rgb, ovl_a, row_x0, row_x1)
+
+class FilmGrain:
     """
-    Simulates film gate weave (jitter) by rolling the image.
+    Film grain sampled from a tile generated ONCE per clip.
+    Each frame takes a window at a random offset, so no per-frame RNG pass.
     """
-    if max_shift == 0:
-        return arr
-        
-    dx = random.randint(-max_shift, max_shift)
-    dy = random.randint(-max_shift, max_shift)
-    
-    arr = np.roll(arr, dx, axis=1) # Shift X
-    arr = np.roll(arr, dy, axis=0) # Shift Y
-    
-    return arr
+    MARGIN = 64
+
+    def __init__(self, amount, video_size):
+        self.width, self.height = video_size
+        self.tile = np.random.randint(
+            -amount, amount + 1,
+            (self.height + self.MARGIN, self.width + self.MARGIN, 3),
+            dtype=np.int8
+        )
+
+    def sample(self):
+        oy = random.randrange(self.MARGIN)
+        ox = random.randrange(self.MARGIN)
+        return self.tile[oy:oy + self.height, ox:ox + self.width]
 
 # --- LIGHT LEAK MANAGER ---
 
 class LightLeakManager:
-    def __init__(self, leaks_dir, video_size):
+    def __init__(self, leaks_dir, video_size, n_frames):
         self.leaks = []
-        self.active_leak_idx = -1
-        self.opacity = 0.0
-        self.state = 'idle' # idle, fade_in, active, fade_out
-        self.duration_counter = 0
+        # Per-frame schedule, simulated ONCE for the whole clip
+        self.opacity_schedule = np.zeros(n_frames, dtype=np.uint8) # 8-bit fixed point
+        self.leak_idx_schedule = np.zeros(n_frames, dtype=np.uint8)
         
         # Load 5 random leaks
         all_leaks = glob.glob(os.path.join(leaks_dir, "*.jpg")) + glob.glob(os.path.join(leaks_dir, "*.png"))
@@ -162,180 +219,163 @@ class LightLeakManager:
         for p in selected_paths:
             try:
                 img = Image.open(p).convert('RGB').resize(video_size, Image.Resampling.BILINEAR)
-                # Convert to float32 array for fast additive blending
-                self.leaks.append(np.array(img, dtype=np.float32))
+                # Kept as uint8: the blend runs in fixed point
+                self.leaks.append(np.array(img, dtype=np.uint8))
             except Exception as e:
                 logger.warning(f"Failed to load leak {p}: {e}")
 
-    def apply(self, frame_arr):
-        if not self.leaks:
-            return frame_arr
-            
-        # State Machine
-        if self.state == 'idle':
-            if random.random() < 0.02: # 2% chance per frame to start a leak
-                self.state = 'fade_in'
-                self.active_leak_idx = random.randint(0, len(self.leaks) - 1)
-                self.opacity = 0.0
-                
-        elif self.state == 'fade_in':
-            self.opacity += 0.05
-            if self.opacity >= 0.8: # Max opacity
-                self.state = 'active'
-                self.duration_counter = random.randint(10, 30) # Hold for 10-30 frames
-                
-        elif self.state == 'active':
-            self.duration_counter -= 1
-            if self.duration_counter <= 0:
-                self.state = 'fade_out'
-                
-        elif self.state == 'fade_out':
-            self.opacity -= 0.03
-            if self.opacity <= 0:
-                self.opacity = 0.0
-                self.state = 'idle'
+        if self.leaks:
+            self._simulate(n_frames)
+
+    def _simulate(self, n_frames):
+        """Runs the leak state machine over every frame of the clip up front."""
+        active_leak_idx = 0
+        opacity = 0.0
+        state = 'idle' # idle, fade_in, active, fade_out
+        duration_counter = 0
         
-        # Apply Leak if visible
-        if self.opacity > 0.01:
-            leak_arr = self.leaks[self.active_leak_idx]
-            # Additive Blending: Frame + (Leak * Opacity)
-            # We use float32 for precision then clip
-            frame_float = frame_arr.astype(np.float32)
-            blended = frame_float + (leak_arr * self.opacity)
-            return np.clip(blended, 0, 255).astype(np.uint8)
+        for i in range(n_frames):
+            # State Machine
+            if state == 'idle':
+                if random.random() < 0.02: # 2% chance per frame to start a leak
+                    state = 'fade_in'
+                    active_leak_idx = random.randint(0, len(self.leaks) - 1)
+                    opacity = 0.0
+                    
+            elif state == 'fade_in':
+                opacity += 0.05
+                if opacity >= 0.8: # Max opacity
+                    state = 'active'
+                    duration_counter = random.randint(10, 30) # Hold for 10-30 frames
+                    
+            elif state == 'active':
+                duration_counter -= 1
+                if duration_counter <= 0:
+                    state = 'fade_out'
+                    
+            elif state == 'fade_out':
+                opacity -= 0.03
+                if opacity <= 0:
+                    opacity = 0.0
+                    state = 'idle'
             
-        return frame_arr
+            # Leak is only blended while visible
+            if opacity > 0.01:
+                self.opacity_schedule[i] = int(opacity * 256)
+                self.leak_idx_schedule[i] = active_leak_idx
 
-# --- VECTORIZED FILTERS ---
+    def leak_for_frame(self, frame_idx):
+        """
+        Returns the leak to blend on frame_idx as (leak_arr, opacity_q8),
+        with opacity in 8-bit fixed point.
+        """
+        frame_idx = min(frame_idx, len(self.opacity_schedule) - 1)
+        opacity_q8 = int(self.opacity_schedule[frame_idx])
+        if opacity_q8:
+            return self.leaks[self.leak_idx_schedule[frame_idx]], opacity_q8
+        return NO_LEAK, 0
 
-def apply_filter_modern_fuji_sim(img):
-    # PIL Adjustments
-    img = ImageEnhance.Contrast(img).enhance(0.95)
-    img = ImageEnhance.Brightness(img).enhance(1.05)
-    img = apply_clarity_softening(img, 0)
-    
-    # Vectorized Pixel Manipulation
-    arr = np.array(img, dtype=np.float32)
-    
-    # Calculate Luma: 0.299*R + 0.587*G + 0.114*B
-    luma = np.dot(arr[..., :3], [0.299, 0.587, 0.114])
-    luma = np.stack([luma]*3, axis=-1) # Make it (H, W, 3)
-    
-    # Color Shift
-    # R + 15, G + 5, B - 10
-    shift = np.array([15, 5, -10], dtype=np.float32)
-    shifted = arr + shift
-    
-    # Blend with Luma (Saturation reduction/Bleach bypass effect)
-    blend_factor = 0.05
-    result = shifted * (1 - blend_factor) + luma * blend_factor
-    
-    # Clip and convert
-    result = np.clip(result, 0, 255).astype(np.uint8)
-    return Image.fromarray(result)
-
-def apply_filter_terracotta_sun_sim(img):
-    img = apply_clarity_softening(img, 4.0)
-    img = ImageEnhance.Contrast(img).enhance(0.85)
-    img = ImageEnhance.Color(img).enhance(1.35)
-    
-    arr = np.array(img, dtype=np.int16)
-    r, g, b = arr[..., 0], arr[..., 1], arr[..., 2]
-    
-    # Vectorized Blue Check
-    avg_rg = (r + g) // 2
-    is_blue = b > (avg_rg + 30)
-    
-    # Apply shifts based on mask
-    r_shift = np.where(is_blue, 15, 40)
-    g_shift = np.where(is_blue, -10, -5)
-    b_shift = np.where(is_blue, -70, -35)
-    
-    arr[..., 0] += r_shift
-    arr[..., 1] += g_shift
-    arr[..., 2] += b_shift
-    
-    arr = np.clip(arr, 0, 255).astype(np.uint8)
-    
-    # Add Grain (Amount 5)
-    arr = add_noise_vectorized(arr, 5)
-    
-    return Image.fromarray(arr)
+# --- FUSED FILM SIMULATIONS ---
+# filter name -> (Numba grade function, clarity softening strength, grain amount)
+# The softening is linear, so running it ahead of the fused color grade
+# matches the original PIL ordering.
 
-def apply_filter_portra_800_sim(img):
-    img = ImageEnhance.Brightness(img).enhance(1.08)
-    img = ImageEnhance.Contrast(img).enhance(0.85)
-    img = ImageEnhance.Color(img).enhance(1.3)
-    img = apply_clarity_softening(img, 1.5)
-    
-    arr = np.array(img, dtype=np.int16)
-    
-    # R + 19, G + 10, B - 33
-    arr[..., 0] += 19
-    arr[..., 1] += 10
-    arr[..., 2] -= 33
-    
-    arr = np.clip(arr, 0, 255).astype(np.uint8)
-    
-    # Grain Amount 15
-    arr = add_noise_vectorized(arr, 15)
-    
-    return Image.fromarray(arr)
+FILM_SIMULATIONS = {
+    "modern_fuji_sim": (fuji_grade, 0, 0),
+    "terracotta_sun_sim": (terracotta_grade, 4.0, 5),
+    "portra_800_sim": (portra_grade, 1.5, 15),
+    "reala_ace_sim": (reala_grade, 2, 5),
+    "dreamy_negative_sim": (dreamy_grade, 0, 8)
+}
 
-def apply_filter_reala_ace_sim(img):
-    img = ImageEnhance.Brightness(img).enhance(1.0)
-    img = ImageEnhance.Contrast(img).enhance(0.8)
-    img = ImageEnhance.Color(img).enhance(1.2)
-    img = apply_clarity_softening(img, 2)
-    
-    arr = np.array(img, dtype=np.int16)
-    
-    # R - 11, G + 10, B + 11
-    arr[..., 0] -= 11
-    arr[..., 1] += 10
-    arr[..., 2] += 11
-    
-    arr = np.clip(arr, 0, 255).astype(np.uint8)
-    
-    # Grain Amount 5
-    arr = add_noise_vectorized(arr, 5)
-    
-    return Image.fromarray(arr)
+# --- FRAME PIPELINE ---
 
-def apply_filter_dreamy_negative_sim(img):
-    img = ImageEnhance.Contrast(img).enhance(0.90)
-    img = ImageEnhance.Color(img).enhance(1.50)
-    img = apply_clarity_softening(img, 0)
-    
-    arr = np.array(img, dtype=np.float32)
-    
-    # WB Shift: R+20, B-20
-    arr[..., 0] += 20
-    arr[..., 2] -= 20
-    
-    # Luma for Shadow/Highlight shaping
-    luma = np.dot(arr[..., :3], [0.299, 0.587, 0.114])
-    
-    # Lift Shadows (luma < 60)
-    shadow_mask = luma < 60
-    lift = (60 - luma) * 0.2
-    lift = np.where(shadow_mask, lift, 0)
-    lift = np.stack([lift]*3, axis=-1)
-    arr += lift
-    
-    # Darken Highlights (luma > 200)
-    highlight_mask = luma > 200
-    darken = (luma - 200) * 0.15
-    darken = np.where(highlight_mask, darken, 0)
-    darken = np.stack([darken]*3, axis=-1)
-    arr -= darken
-    
-    arr = np.clip(arr, 0, 255).astype(np.uint8)
-    
-    # Grain Amount 8
-    arr = add_noise_vectorized(arr, 8)
-    
-    return Image.fromarray(arr)
+class FramePipeline:
+    """
+    Double-buffered frame processing.
+    While the caller encodes frame N, frame N+1 is already being decoded and
+    filtered on a worker thread (the Numba kernels release the GIL).
+    process_frame(frame, t) must alternate between two output buffers, since
+    the yielded frame is still being encoded while the next one is built.
+    Close the generator when done with it (even on error): that is what
+    waits for the last prefetch, so the worker never outlives the run.
+    """
+    def __init__(self, process_frame):
+        self.process_frame = process_frame
+
+    def run(self, timed_frames):
+        """Yields process_frame(frame, t) for each (t, frame) in timed_frames."""
+        # Only the worker thread ever touches the decoder iterator
+        frames = iter(timed_frames)
+
+        def step():
+            for t, frame in frames:
+                return self.process_frame(frame, t)
+            return None
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(step)
+            try:
+                while True:
+                    result = pending.result()
+                    if result is None:
+                        return
+                    pending = executor.submit(step)
+                    yield result
+            finally:
+                # A pending prefetch is always awaited first, so it can't
+                # race a later run over the shared buffers and decoder
+                pending.cancel()
+                wait([pending])
+
+# --- VIDEO WRITER ---
+
+# Encoder settings: realtime bitrate target so the encoder never backpressures
+# the filters. (No -q:v: VideoToolbox ignores -b:v when a quality level is set.)
+VIDEOTOOLBOX_ARGS = ['-c:v', 'h264_videotoolbox', '-realtime', '1', '-allow_sw', '0', '-b:v', '8M']
+LIBX264_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-crf', '23']
+
+def write_video(frames, output_path, video_size, fps, duration, audio_path, codec_args):
+    """
+    Pipes raw RGB frames straight into an ffmpeg subprocess, muxing in the
+    first `duration` seconds of audio_path's audio track (if it has one).
+    Raises IOError if ffmpeg fails.
+    """
+    width, height = video_size
+    # yuv420p is what players expect, but it needs even dimensions;
+    # for odd sizes let ffmpeg pick a format the encoder supports
+    pix_fmt = ['-pix_fmt', 'yuv420p'] if width % 2 == 0 and height % 2 == 0 else []
+    cmd = [
+        FFMPEG_BINARY, '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', f'{fps}', '-i', '-',
+        # Trim the audio input (not the output), so a preview's audio stops
+        # with the clip but short audio never cuts video frames
+        '-t', f'{duration}', '-i', audio_path,
+        '-map', '0:v', '-map', '1:a?',
+        *codec_args,
+        *pix_fmt, '-c:a', 'aac',
+        output_path
+    ]
+    # stderr goes to a file so a chatty ffmpeg can never block on a full pipe
+    with tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=errors)
+        try:
+            for frame in frames:
+                # Frames are C-contiguous uint8, so this writes the buffer as-is
+                proc.stdin.write(frame)
+        except BrokenPipeError:
+            pass # ffmpeg quit early; its exit code and log say why
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
+        
+        if returncode != 0:
+            errors.seek(0)
+            message = errors.read().decode(errors='replace').strip()
+            raise IOError(f"ffmpeg exited with code {returncode}: {message}")
 
 # --- MAIN PROCESSING ---
 
@@ -413,14 +453,7 @@ if __name__ == "__main__":
         # Get Configuration
         config = get_user_inputs()
         
-        filter_funcs = {
-            "modern_fuji_sim": apply_filter_modern_fuji_sim,
-            "terracotta_sun_sim": apply_filter_terracotta_sun_sim,
-            "portra_800_sim": apply_filter_portra_800_sim,
-            "reala_ace_sim": apply_filter_reala_ace_sim,
-            "dreamy_negative_sim": apply_filter_dreamy_negative_sim
-        }
-        selected_filter = filter_funcs[config["filter_name"]]
+        grade, clarity_strength, grain_amount = FILM_SIMULATIONS[config["filter_name"]]
 
         logger.info(f"Processing video: {input_video_path}")
         logger.info(f"Settings: {config}")
@@ -439,61 +472,75 @@ if __name__ == "__main__":
         # Pre-render the timestamp overlay ONCE
         logger.info("Generating timestamp overlay...")
         overlay_img = create_timestamp_overlay(clip.size, config["timestamp"], config["message"])
+        overlay = split_overlay(overlay_img)
+        
+        # Compile-time settings for the frame kernel
+        ca_shift = 2 if config["enable_aberration"] else 0
+        max_jitter = 1 if config["enable_jitter"] else 0
+
+        # Allocate every per-frame buffer ONCE
+        workspace = FrameWorkspace(clip.size, max_jitter, clarity_strength > 0)
+
+        # Set up clarity softening ONCE
+        softener = None
+        if clarity_strength > 0:
+            softener = ClaritySoftener(clarity_strength, workspace)
+        
+        # Pre-generate the grain tile ONCE (only if this filter has grain)
+        grain = None
+        if grain_amount > 0:
+            grain = FilmGrain(grain_amount, clip.size)
         
         # Initialize Light Leak Manager
         leak_manager = None
         if config["enable_leaks"]:
-            leak_manager = LightLeakManager("light_leaks", clip.size)
+            n_frames = int(clip.duration * clip.fps) + 1
+            leak_manager = LightLeakManager("light_leaks", clip.size, n_frames)
 
-        def process_frame(frame):
-            # 1. Convert to PIL
-            img = Image.fromarray(frame)
-            
-            # 2. Apply Vectorized Filter
-            img = selected_filter(img)
-            
-            # 3. Composite Overlay
-            img = img.convert('RGBA')
-            img = Image.alpha_composite(img, overlay_img)
-            img = img.convert('RGB')
+        # Compile the frame kernel ONCE for exactly these settings
+        frame_kernel = build_frame_kernel(
+            grade, grain is not None, ca_shift, max_jitter, leak_manager is not None
+        )
+
+        def process_frame(frame, t):
+            # Works directly on moviepy's uint8 ndarray; PIL is never touched per frame
+            arr = softener.apply(frame) if softener else frame
             
-            # 4. Apply Final Vectorized Effects
-            arr = np.array(img)
+            dx = random.randint(-max_jitter, max_jitter)
+            dy = random.randint(-max_jitter, max_jitter)
             
-            if config["enable_aberration"]:
-                arr = apply_chromatic_aberration(arr, shift_amount=2)
-                
-            if config["enable_jitter"]:
-                arr = apply_jitter(arr, max_shift=1)
-                
+            leak, opacity_q8 = NO_LEAK, 0
             if leak_manager:
-                arr = leak_manager.apply(arr)
+                leak, opacity_q8 = leak_manager.leak_for_frame(int(round(t * clip.fps)))
+            
+            noise = grain.sample() if grain else NO_GRAIN
             
-            return arr
+            # Grade + Grain, Overlay, Aberration/Jitter, Leak in one kernel call
+            return frame_kernel(
+                arr, workspace.next_output(), workspace.stage, noise,
+                overlay, dx, dy, leak, opacity_q8
+            )
 
-        # Apply processing
-        processed_clip = clip.image_transform(process_frame)
+        def render(codec_args):
+            # Decode + filter of frame N+1 overlaps encoding of frame N
+            pipeline = FramePipeline(process_frame)
+            frames = clip.iter_frames(with_times=True, dtype='uint8', logger='bar')
+            # closing() stops the worker before a failed attempt returns, so the
+            # fallback never shares the workspace or decoder with it
+            with contextlib.closing(pipeline.run(frames)) as processed:
+                write_video(
+                    processed, output_video_path, clip.size, clip.fps, clip.duration,
+                    input_video_path, codec_args
+                )
         
         # Write output
         try:
             logger.info("Attempting to use Apple M4 Hardware Acceleration (h264_videotoolbox)...")
-            processed_clip.write_videofile(
-                output_video_path, 
-                audio=True, 
-                threads=8, 
-                codec='h264_videotoolbox',
-                ffmpeg_params=['-q:v', '50'],
-                logger='bar' 
-            )
+            render(VIDEOTOOLBOX_ARGS)
         except Exception as e:
             logger.warning(f"Hardware acceleration failed: {e}")
             logger.info("Falling back to standard libx264 encoding...")
-            processed_clip.write_videofile(
-                output_video_path, 
-                audio=True, 
-                threads=4, 
-                codec='libx264'
-            )
+            render(LIBX264_ARGS)
         
         logger.info(f"Done! Saved to: {output_video_path}")
         